@@ -1,16 +1,35 @@
 import logging
 import re
 import os
+import signal
 import sys
 import asyncio
 import json
+import multiprocessing
+import pickle
+import secrets
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional, Tuple, List
+from typing import Deque, Dict, Optional, Tuple, List, Union
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import yt_dlp
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import CommandStart
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 # =========================
 # НАСТРОЙКИ / ENV
@@ -41,19 +60,97 @@ DEFAULT_UA = (
     "AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.6 Safari/605.1.15"
 )
 
+# 5) Размер пула потоков по умолчанию (asyncio.to_thread / run_in_executor)
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "32"))
+
+# 6) Отдельный пул под yt-dlp, чтобы долгие скачивания не занимали общий пул
+DOWNLOAD_POOL_SIZE = int(os.getenv("DOWNLOAD_POOL_SIZE", "4"))
+# YTDLP_PROCESS_POOL=1 — качать в отдельных процессах вместо потоков: yt-dlp/ffmpeg грузят
+# разные ядра без GIL, а утечки и падения нативного кода не задевают бота.
+# Процессы стартуют через spawn и заново импортируют этот модуль — поэтому при импорте
+# нет побочных эффектов: БД статистики, пул скачиваний и бот создаются только в main().
+YTDLP_PROCESS_POOL = os.getenv("YTDLP_PROCESS_POOL", "").strip() not in ("", "0")
+# сколько скачиваний реально идёт одновременно (остальные ждут в очереди event loop) — это потолок:
+# лимит подстраивается по AIMD — растёт, пока среднее время скачивания в секундах на МБ не выше
+# DOWNLOAD_TARGET_SEC_PER_MB (видео меньше 10 МБ считаются за 10 МБ: у них время уходит на извлечение),
+# и уменьшается вдвое при медленных скачиваниях; при анти-бот ошибках/429 ещё и пауза на DOWNLOAD_THROTTLE_COOLDOWN
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", str(DOWNLOAD_POOL_SIZE)))
+DOWNLOAD_TARGET_SEC_PER_MB = float(os.getenv("DOWNLOAD_TARGET_SEC_PER_MB", "1"))
+DOWNLOAD_THROTTLE_COOLDOWN = float(os.getenv("DOWNLOAD_THROTTLE_COOLDOWN", "30"))
+
+# 7) Параллельные фрагменты DASH/HLS (аналог yt-dlp -N) и размер HTTP-чанка
+#    (10 МБ — выше YouTube начинает троттлить)
+YTDLP_CONCURRENT_FRAGMENTS = int(os.getenv("YTDLP_CONCURRENT_FRAGMENTS", "4"))
+YTDLP_HTTP_CHUNK_SIZE = int(os.getenv("YTDLP_HTTP_CHUNK_SIZE", str(10 * 1024 * 1024)))
+#    YTDLP_ARIA2C=1 — прямые HTTP-скачивания через aria2c в несколько соединений (если он установлен).
+#    Внешний загрузчик не отдаёт прогресс, поэтому обрыв по размеру на лету для них не работает —
+#    остаются только проверки по заранее известному размеру.
+YTDLP_ARIA2C = os.getenv("YTDLP_ARIA2C", "").strip() not in ("", "0")
+YTDLP_ARIA2C_CONNECTIONS = int(os.getenv("YTDLP_ARIA2C_CONNECTIONS", "8"))
+#    YTDLP_CACHE_DIR — где yt-dlp хранит разобранный player JS/подписи YouTube между рестартами
+#    (например, /mnt/data/ytdlp-cache на постоянном диске). Пусто — ~/.cache/yt-dlp.
+YTDLP_CACHE_DIR = os.getenv("YTDLP_CACHE_DIR", "").strip()
+
+# 8) Размер чанка при отправке файла в Telegram: файл читается потоком,
+#    каждый чанк — отдельный заход в пул потоков (aiofiles), поэтому крупнее дефолтных 64 КБ
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+# 9) Пул соединений к Bot API: лимит одновременных запросов
+TELEGRAM_POOL_LIMIT = int(os.getenv("TELEGRAM_POOL_LIMIT", "100"))
+
+# 10) Лимит скачиваний на пользователя (token bucket): до USER_RATE_BURST подряд,
+#     дальше одно скачивание раз в USER_RATE_PERIOD секунд
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST", "3"))
+USER_RATE_PERIOD = float(os.getenv("USER_RATE_PERIOD", "30"))
+#     и сколько скачиваний одного пользователя идёт одновременно (остальные ждут своей очереди)
+USER_CONCURRENT_DOWNLOADS = int(os.getenv("USER_CONCURRENT_DOWNLOADS", "1"))
+
+# 11) Лимиты исходящих запросов к Bot API (как у Telegram): всего сообщений в секунду,
+#     в один личный чат (окно с небольшим запасом на серию ответов) и в одну группу в минуту
+TELEGRAM_GLOBAL_RATE = int(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_RATE = int(os.getenv("TELEGRAM_GROUP_RATE", "20"))
+
+# 12) Куда качать видео. На контейнерах лучше указать tmpfs (например, /dev/shm),
+#     тогда файл до отправки не касается диска. Пусто — системный temp.
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "").strip() or None
+
+# 13) Локальный Bot API сервер (telegram-bot-api --local), например http://localhost:8081.
+#     Видео тогда передаётся ему путём к файлу, без повторного чтения и HTTP-загрузки;
+#     сервер должен видеть тот же DOWNLOAD_DIR.
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip()
+
+# 14) Webhook вместо long polling: Telegram сам присылает апдейты, без круга getUpdates.
+#     WEBHOOK_URL — полный публичный HTTPS-адрес (путь берётся из него), слушаем WEBHOOK_HOST:PORT.
+#     WEBHOOK_SECRET — токен, без которого запросы к вебхуку отклоняются; не задан — случайный на запуск.
+#     Пусто — работаем через polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or None
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "30"))  # секунд long poll у getUpdates
+
 # =========================
 # ЛОГИРОВАНИЕ
 # =========================
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.DEBUG,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),  # DEBUG — только для отладки
 )
 logger = logging.getLogger(__name__)
 
+# Собственный поток сообщений yt-dlp (прогресс, отладка) — только предупреждения и ошибки.
+# DEBUG_YTDLP=1 включает подробный вывод yt-dlp для разбора проблем со скачиванием.
+DEBUG_YTDLP = os.getenv("DEBUG_YTDLP", "").strip() not in ("", "0")
+ydl_logger = logging.getLogger("ytdlp")
+ydl_logger.setLevel(logging.DEBUG if DEBUG_YTDLP else logging.WARNING)
+
 # =========================
-# ФАЙЛ ДЛЯ СТАТИСТИКИ
+# ХРАНИЛИЩЕ СТАТИСТИКИ
 # =========================
-USER_STATS_FILE = "user_stats.json"
+USER_STATS_DB = os.getenv("USER_STATS_DB", "user_stats.db")
+USER_STATS_FILE = "user_stats.json"  # старый JSON-формат, импортируется в БД один раз
+STATS_FLUSH_INTERVAL = 0.5  # секунд между пакетными записями в БД
 
 # =========================
 # УТИЛИТЫ
@@ -68,14 +165,37 @@ def get_telegram_token() -> str:
     sys.exit(1)
 
 
-def find_cookiefile() -> Optional[str]:
-    """Возвращает путь к валидному Netscape cookies.txt или None."""
+# Результат find_cookiefile, привязанный к mtime файлов-кандидатов
+_cookiefile_cache: dict = {"key": None, "path": None}
+
+
+def find_cookiefile() -> Tuple[Optional[str], Optional[int]]:
+    """
+    Возвращает (путь к валидному Netscape cookies.txt или None, его st_mtime_ns).
+    Файлы перечитываются, только если у кандидатов сменился mtime (или они появились/пропали);
+    mtime отдаётся наружу, чтобы пересоздать YoutubeDL, когда файл заменили по тому же пути.
+    """
     env_path = os.getenv("COOKIES_PATH", "").strip()
     candidates: List[str] = []
     if env_path:
         candidates.append(env_path)
     candidates.extend(DEFAULT_COOKIES_CANDIDATES)
 
+    key = []
+    for p in candidates:
+        try:
+            key.append((p, os.stat(p).st_mtime_ns))
+        except OSError:
+            key.append((p, None))
+    key = tuple(key)
+    if key != _cookiefile_cache["key"]:
+        _cookiefile_cache["path"] = _scan_cookiefile(candidates)
+        _cookiefile_cache["key"] = key
+    path = _cookiefile_cache["path"]
+    return path, dict(key).get(path)
+
+
+def _scan_cookiefile(candidates: List[str]) -> Optional[str]:
     for p in candidates:
         if not p:
             continue
@@ -123,22 +243,67 @@ def build_po_token_entry() -> Optional[str]:
     return entry
 
 
-def is_valid_url(url: str) -> bool:
-    patterns = [
-        r'(?:https?://)?(?:www\.)?(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/|youtube\.com/v/|m\.youtube\.com/watch\?v=)[\w-]+',
-        r'(?:https?://)?(?:www\.)?(?:tiktok\.com/@[\w.-]+/video/\d+|vm\.tiktok\.com/[\w-]+|m\.tiktok\.com/v/\d+)',
-        r'(?:https?://)?(?:www\.)?instagram\.com/(?:p|reel|tv)/[\w-]+',
-        r'(?:https?://)?(?:www\.)?(?:twitter\.com|x\.com)/\w+/status/\d+',
-        r'(?:https?://)?(?:www\.)?facebook\.com/.*?/videos/\d+',
-        r'(?:https?://)?[\w.-]+\.[\w]{2,}(?:/[\w.-]*)*/?',
-    ]
-    for pattern in patterns:
-        if re.match(pattern, url, re.IGNORECASE):
-            return True
-    return False
+# Хост -> платформа; поддомены (www., m., vm. ...) находятся проходом по суффиксам
+_PLATFORM_HOSTS = {
+    "youtube.com": "YouTube",
+    "youtu.be": "YouTube",
+    "tiktok.com": "TikTok",
+    "instagram.com": "Instagram",
+    "twitter.com": "Twitter/X",
+    "x.com": "Twitter/X",
+    "facebook.com": "Facebook",
+}
+
+
+_SCHEME_RE = re.compile(r"([a-zA-Z][a-zA-Z0-9+.-]*)://")
+
+
+def url_host(url: str) -> Optional[str]:
+    """Хост ссылки в нижнем регистре (схема необязательна, но только http/https) или None."""
+    scheme = _SCHEME_RE.match(url)
+    if scheme:
+        if scheme.group(1).lower() not in ("http", "https"):
+            return None
+    else:
+        url = "http://" + url
+    try:
+        return urlsplit(url).hostname
+    except ValueError:
+        return None
+
+
+def platform_for_host(host: str) -> Optional[str]:
+    while True:
+        platform = _PLATFORM_HOSTS.get(host)
+        if platform is not None:
+            return platform
+        _, dot, host = host.partition(".")
+        if not dot:
+            return None
+
+
+MAX_URL_LENGTH = 2048
+MAX_HOST_LENGTH = 253  # предел длины доменного имени в DNS
+MIN_URL_LENGTH = 4  # "x.co" — короче ссылки не бывает
+_SPACE_RE = re.compile(r"\s")
+
+
+def link_host(url: str) -> Optional[str]:
+    """Хост, если текст похож на ссылку (одно слово с доменом), иначе None."""
+    # обычный текст отбрасываем дешёвыми проверками, не доходя до разбора:
+    # длина, точка в строке (без неё нет домена) и пробелы (поиск на C, без генератора)
+    if not MIN_URL_LENGTH <= len(url) <= MAX_URL_LENGTH or "." not in url or _SPACE_RE.search(url):
+        return None
+    host = url_host(url)
+    if not host or len(host) > MAX_HOST_LENGTH or "." not in host:
+        return None
+    if len(host.rsplit(".", 1)[1]) < 2:
+        return None
+    return host
 
 
-def load_user_stats():
+def load_legacy_stats():
+    """Читает старый user_stats.json (нужно только для миграции в SQLite)."""
     try:
         if os.path.exists(USER_STATS_FILE):
             with open(USER_STATS_FILE, "r", encoding="utf-8") as f:
@@ -148,91 +313,518 @@ def load_user_stats():
     return {}
 
 
-def save_user_stats(stats):
+def iso_to_ts(value: str) -> int:
+    """Старые метки времени (datetime.isoformat, локальное время) -> unix-время."""
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+def import_legacy_stats(db: sqlite3.Connection):
+    """Переносит user_stats.json в пустую БД, чтобы не потерять старую статистику."""
+    if db.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+        return
+    stats = load_legacy_stats()
+    if not stats:
+        return
+    with db:
+        for user_id_str, s in stats.items():
+            db.execute(
+                "INSERT OR IGNORE INTO users (user_id, downloads_count, total_size, first_use_ts, last_activity_ts) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    int(user_id_str),
+                    s["downloads_count"],
+                    s["total_size"],
+                    iso_to_ts(s["first_use"]),
+                    iso_to_ts(s["last_activity"]),
+                ),
+            )
+            db.executemany(
+                "INSERT OR IGNORE INTO platforms (user_id, platform, count) VALUES (?, ?, ?)",
+                [(int(user_id_str), platform, count) for platform, count in s["platforms"].items()],
+            )
+    logger.info(f"Imported stats of {len(stats)} users from {USER_STATS_FILE} into {USER_STATS_DB}")
+
+
+def open_stats_db() -> sqlite3.Connection:
+    """
+    Открывает SQLite с WAL: обновление статистики — это UPSERT одной строки,
+    а не перезапись всего файла, и чтение не блокируется записью.
+    """
+    db = sqlite3.connect(USER_STATS_DB, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            downloads_count INTEGER NOT NULL DEFAULT 0,
+            total_size INTEGER NOT NULL DEFAULT 0,
+            first_use_ts INTEGER NOT NULL,
+            last_activity_ts INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS platforms (
+            user_id INTEGER NOT NULL,
+            platform TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, platform)
+        ) WITHOUT ROWID;
+        """
+    )
     try:
-        with open(USER_STATS_FILE, "w", encoding="utf-8") as f:
-            json.dump(stats, f, ensure_ascii=False, indent=2)
+        import_legacy_stats(db)
     except Exception as e:
+        logger.error(f"Error importing legacy user stats: {e}")
+    return db
+
+
+# Открывается в main() (init_stats_storage), а не при импорте: модуль импортируют и процессы
+# пула скачиваний (YTDLP_PROCESS_POOL), им БД и статистика не нужны.
+stats_db: Optional[sqlite3.Connection] = None
+# Соединение общее для всех потоков пула — транзакции не должны перемешиваться
+stats_db_lock = threading.Lock()
+
+
+def load_user_stats() -> dict:
+    """Читает всю статистику из БД в словарь {str(user_id): {...}} (один раз при старте)."""
+    stats = {}
+    try:
+        with stats_db_lock:
+            users = stats_db.execute(
+                "SELECT user_id, downloads_count, total_size, first_use_ts, last_activity_ts FROM users"
+            ).fetchall()
+            platforms = stats_db.execute(
+                "SELECT user_id, platform, count FROM platforms ORDER BY user_id, platform"
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Error loading user stats: {e}")
+        return stats
+    for user_id, downloads_count, total_size, first_use_ts, last_activity_ts in users:
+        stats[str(user_id)] = {
+            "downloads_count": downloads_count,
+            "total_size": total_size,
+            "platforms": {},
+            "first_use_ts": first_use_ts,
+            "last_activity_ts": last_activity_ts,
+            "favorite_platform": None,
+            "favorite_count": 0,
+            "stats_text": None,  # готовый текст экрана статистики, сбрасывается при обновлении
+        }
+    for user_id, platform, count in platforms:
+        user = stats.get(str(user_id))
+        if user is not None:
+            set_platform_count(user, platform, count)
+    return stats
+
+
+def set_platform_count(user: dict, platform: str, count: int):
+    """
+    Записывает счётчик платформы и ведёт любимую платформу на ходу, чтобы экран статистики
+    не искал максимум. При равенстве выигрывает первая по алфавиту — и при загрузке, и при обновлении.
+    """
+    user["platforms"][platform] = count
+    favorite = user["favorite_platform"]
+    if count > user["favorite_count"] or (count == user["favorite_count"] and platform < favorite):
+        user["favorite_platform"] = platform
+        user["favorite_count"] = count
+
+
+# Статистика живёт в памяти: чтение — поиск в словаре, БД только догоняет изменения.
+# Меняется только из event loop, поэтому блокировка не нужна.
+user_stats: Dict[str, dict] = {}
+
+
+def init_stats_storage():
+    """Открывает БД статистики и загружает её в память (один раз при старте бота)."""
+    global stats_db
+    stats_db = open_stats_db()
+    user_stats.update(load_user_stats())
+
+
+def get_user_stats(user_id: int):
+    return user_stats.get(str(user_id))
+
+
+def save_user_stats(updates: List[Tuple[int, str, int, int]]):
+    """Применяет пачку (user_id, platform, file_size, timestamp) одной транзакцией."""
+    try:
+        with stats_db_lock, stats_db:
+            stats_db.executemany(
+                "INSERT INTO users (user_id, downloads_count, total_size, first_use_ts, last_activity_ts) "
+                "VALUES (?, 1, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "downloads_count = downloads_count + 1, "
+                "total_size = total_size + excluded.total_size, "
+                "last_activity_ts = excluded.last_activity_ts",
+                [(user_id, file_size, ts, ts) for user_id, _, file_size, ts in updates],
+            )
+            stats_db.executemany(
+                "INSERT INTO platforms (user_id, platform, count) VALUES (?, ?, 1) "
+                "ON CONFLICT(user_id, platform) DO UPDATE SET count = count + 1",
+                [(user_id, platform) for user_id, platform, _, _ in updates],
+            )
+    except sqlite3.Error as e:
         logger.error(f"Error saving user stats: {e}")
 
 
-def update_user_stats(user_id: int, platform: str, file_size: int = 0):
-    stats = load_user_stats()
-    user_id_str = str(user_id)
+# Обновления копятся в очереди и пишутся в БД пачками фоновой задачей
+stats_queue: asyncio.Queue = asyncio.Queue(maxsize=1024)
+
 
-    if user_id_str not in stats:
-        stats[user_id_str] = {
+async def update_user_stats(user_id: int, platform: str, file_size: int = 0):
+    now = int(time.time())  # в читаемый вид переводится только при показе статистики
+    user_id_str = str(user_id)
+    if user_id_str not in user_stats:
+        user_stats[user_id_str] = {
             "downloads_count": 0,
             "total_size": 0,
             "platforms": {},
-            "first_use": datetime.now().isoformat(),
-            "last_activity": datetime.now().isoformat(),
+            "first_use_ts": now,
+            "last_activity_ts": now,
+            "favorite_platform": None,
+            "favorite_count": 0,
+            "stats_text": None,
         }
+    user = user_stats[user_id_str]
+    user["downloads_count"] += 1
+    user["total_size"] += file_size
+    user["last_activity_ts"] = now
+    set_platform_count(user, platform, user["platforms"].get(platform, 0) + 1)
+    user["stats_text"] = None
 
-    stats[user_id_str]["downloads_count"] += 1
-    stats[user_id_str]["total_size"] += file_size
-    stats[user_id_str]["last_activity"] = datetime.now().isoformat()
-    stats[user_id_str]["platforms"][platform] = stats[user_id_str]["platforms"].get(platform, 0) + 1
+    await stats_queue.put((user_id, platform, file_size, now))
 
-    save_user_stats(stats)
 
+def drain_stats_queue() -> List[Tuple[int, str, int, int]]:
+    updates = []
+    while True:
+        try:
+            updates.append(stats_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            return updates
 
-def get_user_stats(user_id: int):
-    stats = load_user_stats()
-    return stats.get(str(user_id), None)
+
+async def stats_flusher():
+    """Раз в STATS_FLUSH_INTERVAL секунд сбрасывает накопленные обновления в БД."""
+    while True:
+        updates = [await stats_queue.get()]
+        updates.extend(drain_stats_queue())
+        await asyncio.to_thread(save_user_stats, updates)
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
 
 
-def detect_platform(url: str) -> str:
-    if "youtube.com" in url or "youtu.be" in url:
-        return "YouTube"
-    if "tiktok.com" in url:
-        return "TikTok"
-    if "instagram.com" in url:
-        return "Instagram"
-    if "twitter.com" in url or "x.com" in url:
-        return "Twitter/X"
-    if "facebook.com" in url:
-        return "Facebook"
-    return "Другое"
+_SIZE_UNITS = ("Б", "КБ", "МБ", "ГБ", "ТБ")
 
 
 def format_file_size(size_bytes: int) -> str:
-    if size_bytes == 0:
+    if size_bytes <= 0:
         return "0 Б"
-    size_names = ["Б", "КБ", "МБ", "ГБ", "ТБ"]
-    i = 0
-    size = float(size_bytes)
-    while size >= 1024.0 and i < len(size_names) - 1:
-        size /= 1024.0
-        i += 1
-    return f"{size:.1f} {size_names[i]}"
+    # номер единицы = floor(log1024(size)), считаем по длине числа в битах без цикла
+    i = min((size_bytes.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (10 * i)):.1f} {_SIZE_UNITS[i]}"
+
+
+# =========================
+# ЛИМИТ ЗАПРОСОВ
+# =========================
+# user_id -> (токены, время последнего пополнения по time.monotonic()).
+# Трогается только из event loop, поэтому блокировка не нужна.
+_rate_buckets: Dict[int, Tuple[float, float]] = {}
+RATE_SWEEP_INTERVAL = 300  # секунд между чистками полных корзин
+
+
+def take_rate_token(user_id: int) -> bool:
+    """Списывает токен пользователя; False — лимит исчерпан, скачивать не надо."""
+    now = time.monotonic()
+    tokens, last = _rate_buckets.get(user_id, (USER_RATE_BURST, now))
+    tokens = min(USER_RATE_BURST, tokens + (now - last) / USER_RATE_PERIOD)
+    if tokens < 1:
+        _rate_buckets[user_id] = (tokens, now)
+        return False
+    _rate_buckets[user_id] = (tokens - 1, now)
+    return True
+
+
+# user_id -> [семафор, сколько запросов пользователя его держат или ждут]
+_user_slots: Dict[int, list] = {}
+
+
+@asynccontextmanager
+async def user_download_slot(user_id: int):
+    """Один пользователь не занимает больше USER_CONCURRENT_DOWNLOADS мест в пуле скачиваний."""
+    slot = _user_slots.get(user_id)
+    if slot is None:
+        slot = _user_slots[user_id] = [asyncio.Semaphore(USER_CONCURRENT_DOWNLOADS), 0]
+    slot[1] += 1
+    try:
+        async with slot[0]:
+            yield
+    finally:
+        slot[1] -= 1
+        if not slot[1]:
+            del _user_slots[user_id]
+
+
+class SlidingWindow:
+    """Не больше limit событий за последние period секунд."""
+
+    __slots__ = ("limit", "period", "stamps", "blocked_until")
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self.stamps: Deque[float] = deque()
+        self.blocked_until = 0.0  # до этого момента (time.monotonic) Telegram просил не слать
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до свободного места в окне (0 — можно сейчас)."""
+        stamps = self.stamps
+        while stamps and stamps[0] <= now - self.period:
+            stamps.popleft()
+        if len(stamps) < self.limit:
+            return max(self.blocked_until - now, 0.0)
+        return max(stamps[0] + self.period, self.blocked_until) - now
+
+
+class TelegramRateLimit(BaseRequestMiddleware):
+    """
+    Придерживает исходящие запросы с chat_id, чтобы не упираться в лимиты Telegram
+    и не ловить 429 с повторными попытками. Пока лимит не выбран, ожидания нет.
+    Если 429 всё же пришёл, retry_after ждёт только этот чат, а запрос повторяется один раз.
+    """
+
+    def __init__(self):
+        self.global_window = SlidingWindow(TELEGRAM_GLOBAL_RATE, 1.0)
+        self.chats: Dict[Union[int, str], SlidingWindow] = {}
+
+    def chat_window(self, chat_id: Union[int, str]) -> SlidingWindow:
+        window = self.chats.get(chat_id)
+        if window is None:
+            # отрицательный id (или @username канала) — группа/канал, там лимит поминутный
+            if isinstance(chat_id, str) or chat_id < 0:
+                window = SlidingWindow(TELEGRAM_GROUP_RATE, 60.0)
+            else:
+                window = SlidingWindow(TELEGRAM_CHAT_BURST, float(TELEGRAM_CHAT_BURST))
+            self.chats[chat_id] = window
+        return window
+
+    async def acquire(self, chat_id: Union[int, str]):
+        chat = self.chat_window(chat_id)
+        while True:
+            now = time.monotonic()
+            wait = max(self.global_window.delay(now), chat.delay(now))
+            if wait <= 0:
+                # между проверкой и записью нет await — гонок в одном event loop нет
+                self.global_window.stamps.append(now)
+                chat.stamps.append(now)
+                return
+            await asyncio.sleep(wait)
+
+    def purge(self):
+        """Забывает чаты, у которых окно уже опустело и не действует 429."""
+        now = time.monotonic()
+        idle = [
+            chat_id
+            for chat_id, window in self.chats.items()
+            if (not window.stamps or window.stamps[-1] <= now - window.period) and window.blocked_until <= now
+        ]
+        for chat_id in idle:
+            del self.chats[chat_id]
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        await self.acquire(chat_id)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            logger.warning(f"Telegram flood control for chat {chat_id}: retry after {e.retry_after}s")
+            chat = self.chat_window(chat_id)
+            chat.blocked_until = max(chat.blocked_until, time.monotonic() + e.retry_after)
+            await self.acquire(chat_id)
+            return await make_request(bot, method)
+
+
+telegram_rate_limit = TelegramRateLimit()
+
+
+async def rate_bucket_sweeper():
+    """Удаляет полностью пополненные корзины и окна простаивающих чатов: они ничем не отличаются от новых."""
+    while True:
+        await asyncio.sleep(RATE_SWEEP_INTERVAL)
+        now = time.monotonic()
+        full = [
+            user_id
+            for user_id, (tokens, last) in _rate_buckets.items()
+            if tokens + (now - last) / USER_RATE_PERIOD >= USER_RATE_BURST
+        ]
+        for user_id in full:
+            del _rate_buckets[user_id]
+        telegram_rate_limit.purge()
 
 
 # =========================
 # СКАЧИВАНИЕ ВИДЕО
 # =========================
-async def download_video(url: str) -> Tuple[Optional[Tuple[str, str]], Optional[str]]:
-    po_entry = build_po_token_entry()  # 'web+AAA...' или 'web.remix+AAA...' или None
-    YTDLP_UA = os.getenv("YTDLP_UA", DEFAULT_UA).strip()
-    cookiefile = find_cookiefile()
+def create_download_executor() -> Executor:
+    if YTDLP_PROCESS_POOL:
+        # fork из процесса с потоками (БД, пулы) чреват захваченными блокировками — только spawn
+        return ProcessPoolExecutor(max_workers=DOWNLOAD_POOL_SIZE, mp_context=multiprocessing.get_context("spawn"))
+    return ThreadPoolExecutor(max_workers=DOWNLOAD_POOL_SIZE, thread_name_prefix="ytdlp")
+
+
+# Создаётся в main() (init_downloads): процессы пула сами импортируют модуль, свой пул им не нужен
+DOWNLOAD_EXECUTOR: Optional[Executor] = None
+
+
+# Признаки того, что площадка нас притормаживает (а не проблема конкретного видео)
+_THROTTLE_MARKERS = (
+    "Sign in to confirm you’re not a bot",
+    "Sign in to confirm you're not a bot",
+    "HTTP Error 429",
+    "Too Many Requests",
+    "timed out",
+)
+
 
+class AdaptiveLimiter:
+    """
+    Лимит одновременных скачиваний с AIMD-подстройкой по скорости скачивания (секунд на МБ,
+    чтобы длинные видео не выглядели как перегрузка): +1 место, пока скользящее среднее
+    не выше цели, и вдвое меньше, если выше.
+    Ошибка-троттлинг сразу уменьшает лимит и на время закрывает вход новым скачиваниям.
+    Трогается только из event loop, поэтому блокировка не нужна.
+    """
+
+    MIN_SAMPLE_MB = 10  # у коротких видео время уходит на извлечение, а не на передачу
+
+    def __init__(self, max_limit: int, target_sec_per_mb: float, cooldown: float, window: int = 16):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.target_sec_per_mb = target_sec_per_mb
+        self.cooldown = cooldown
+        self.cooldown_until = 0.0
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.active = 0
+        self.waiters: List[asyncio.Future] = []
+
+    async def acquire(self):
+        while True:
+            pause = self.cooldown_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.active < int(self.limit):
+                self.active += 1
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+    def decrease(self):
+        self.limit = max(1.0, self.limit / 2)
+        self.samples.clear()  # старые замеры относятся к прежнему лимиту
+
+    def release(self, sec_per_mb: Optional[float], throttled: bool):
+        self.active -= 1
+        if throttled:
+            self.decrease()
+            self.cooldown_until = time.monotonic() + self.cooldown
+            logger.warning(f"Download throttled, concurrency limit lowered to {int(self.limit)}")
+        elif sec_per_mb is not None:
+            self.samples.append(sec_per_mb)
+            if sum(self.samples) / len(self.samples) <= self.target_sec_per_mb:
+                self.limit = min(float(self.max_limit), self.limit + 1)
+            else:
+                self.decrease()
+        # освободилось место или поменялся лимит — ожидающие перепроверяют условие сами
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Место под скачивание; в отданный словарь вызывающий кладёт "size" скачанного файла."""
+        await self.acquire()
+        started = time.monotonic()
+        sample = {"size": 0}
+        try:
+            yield sample
+        except BaseException as e:
+            # ошибки самого видео (приватное, слишком большое...) на лимит не влияют
+            self.release(None, any(marker in str(e) for marker in _THROTTLE_MARKERS))
+            raise
+        else:
+            size_mb = max(sample["size"] / (1024 * 1024), self.MIN_SAMPLE_MB)
+            self.release((time.monotonic() - started) / size_mb, False)
+
+
+download_limiter = AdaptiveLimiter(MAX_CONCURRENT_DOWNLOADS, DOWNLOAD_TARGET_SEC_PER_MB, DOWNLOAD_THROTTLE_COOLDOWN)
+
+# Каталоги отправленных видео удаляет фоновая задача — обработчик не ждёт диска
+cleanup_queue: asyncio.Queue = asyncio.Queue()
+
+
+def drain_cleanup_queue() -> List[str]:
+    paths = []
+    while True:
+        try:
+            paths.append(cleanup_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            return paths
+
+
+async def janitor():
+    while True:
+        tmpdir = await cleanup_queue.get()
+        await asyncio.to_thread(shutil.rmtree, tmpdir, ignore_errors=True)
+
+
+MAX_FILE_SIZE = 50 * 1024 * 1024  # лимит Bot API на отправку файла
+
+
+# aria2c не отдаёт прогресс — с ним size_guard не работает
+ARIA2C_ENABLED = YTDLP_ARIA2C and shutil.which("aria2c") is not None
+
+
+def size_guard(d: dict):
+    """
+    progress hook: обрывает скачивание, как только скачано больше лимита.
+    max_filesize срабатывает, только если размер известен заранее (Content-Length),
+    а у HLS/DASH и потоков без длины его нет — иначе докачали бы всё и выбросили.
+    """
+    if (d.get("downloaded_bytes") or 0) > MAX_FILE_SIZE:
+        raise yt_dlp.utils.DownloadCancelled("file exceeds max size")
+
+
+def build_ydl_opts(cookiefile: Optional[str], po_entry: Optional[str], user_agent: str) -> dict:
     # базовые опции
     ydl_opts = {
         "format": "best[height<=720][filesize<50M]/best[filesize<50M]/best",
-        "outtmpl": "downloaded_video.%(ext)s",
+        "outtmpl": "%(id)s.%(ext)s",  # каталог задаётся на каждое скачивание (paths.home)
         "merge_output_format": "mp4",
-        "quiet": False,
+        "quiet": not DEBUG_YTDLP,  # прогресс и отладка yt-dlp не нужны; предупреждения идут в ydl_logger
         "no_warnings": False,
-        "verbose": True,
+        "verbose": DEBUG_YTDLP,
         "noplaylist": True,
-        "max_filesize": 50 * 1024 * 1024,
-        "http_chunk_size": 10 * 1024 * 1024,  # <= 10MB
-        "user_agent": YTDLP_UA,
-        "logger": logger,
+        "max_filesize": MAX_FILE_SIZE,
+        "progress_hooks": [size_guard],
+        # размер проверяется по info выбранного формата в том же проходе, что и скачивание
+        "match_filter": yt_dlp.utils.match_filter_func("filesize<?50M & filesize_approx<?50M"),
+        "break_on_reject": True,
+        "http_chunk_size": YTDLP_HTTP_CHUNK_SIZE,
+        "buffersize": 64 * 1024,  # стартовый размер блока чтения (дальше yt-dlp подстраивает сам)
+        "user_agent": user_agent,
+        "logger": ydl_logger,
         "socket_timeout": 15,
         "extractor_retries": 2,
         "retries": 1,
-        "concurrent_fragment_downloads": 1,
+        "concurrent_fragment_downloads": YTDLP_CONCURRENT_FRAGMENTS,
         "http_headers": {
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
             "Accept-Language": "ru,en;q=0.5",
@@ -246,6 +838,14 @@ async def download_video(url: str) -> Tuple[Optional[Tuple[str, str]], Optional[
         },
     }
 
+    if YTDLP_CACHE_DIR:
+        ydl_opts["cachedir"] = YTDLP_CACHE_DIR
+
+    if ARIA2C_ENABLED:
+        n = str(YTDLP_ARIA2C_CONNECTIONS)
+        ydl_opts["external_downloader"] = {"http": "aria2c"}  # HLS/DASH остаются на встроенном (-N)
+        ydl_opts["external_downloader_args"] = {"aria2c": ["-x", n, "-s", n, "-k", "1M"]}
+
     # куки только для чтения (никаких /etc/secrets)
     if cookiefile:
         ydl_opts["cookiefile"] = cookiefile
@@ -256,52 +856,194 @@ async def download_video(url: str) -> Tuple[Optional[Tuple[str, str]], Optional[
         # для вкладок/плейлистов — иногда требуется
         ydl_opts["extractor_args"]["youtubetab"] = {"po_token": [po_entry]}
 
+    return ydl_opts
+
+
+# ENV за время работы не меняется — PO token и UA читаем один раз при старте.
+# PO token читается в main() (init_downloads) и передаётся в run_download вместе с куками.
+# Куки — нет: файл могут заменить на лету. find_cookiefile отдаёт его mtime, и get_ydl
+# по нему пересоздаёт YoutubeDL (сам yt-dlp читает куки только при создании экземпляра).
+PO_TOKEN_ENTRY: Optional[str] = None  # 'web+AAA...' или 'web.remix+AAA...' или None
+YTDLP_UA = os.getenv("YTDLP_UA", DEFAULT_UA).strip()
+
+
+def init_downloads():
+    """Создаёт пул скачиваний и читает PO token (один раз при старте бота)."""
+    global DOWNLOAD_EXECUTOR, PO_TOKEN_ENTRY
+    DOWNLOAD_EXECUTOR = create_download_executor()
+    PO_TOKEN_ENTRY = build_po_token_entry()
+
+
+# YoutubeDL не потокобезопасен, поэтому держим по экземпляру на поток пула
+# и переиспользуем его между скачиваниями (экстракторы, HTTP-сессии, куки)
+_ydl_local = threading.local()
+
+
+def get_ydl(
+    cookiefile: Optional[str], cookie_mtime: Optional[int], po_entry: Optional[str], user_agent: str
+) -> yt_dlp.YoutubeDL:
+    """
+    Возвращает YoutubeDL текущего потока; пересоздаёт его, только если поменялся конфиг.
+    Куки yt-dlp читает один раз при создании экземпляра, поэтому в ключе и mtime файла:
+    заменённый по тому же пути cookies.txt подхватывается со следующего скачивания.
+    """
+    key = (cookiefile, cookie_mtime, po_entry, user_agent)
+    if getattr(_ydl_local, "key", None) != key:
+        old = getattr(_ydl_local, "ydl", None)
+        if old is not None:
+            # close() дописывает свою cookiejar обратно в cookiefile — затёр бы только что заменённый файл
+            old.params["cookiefile"] = None
+            old.close()
+        _ydl_local.ydl = yt_dlp.YoutubeDL(build_ydl_opts(cookiefile, po_entry, user_agent))
+        _ydl_local.key = key
+    return _ydl_local.ydl
+
+
+# Параметры, которые не влияют на само видео (метки источника/трекинга)
+_TRACKING_PARAMS = {"si", "feature", "fbclid", "igshid", "igsh", "is_from_webapp", "sender_device"}
+
+
+def normalize_url(url: str) -> str:
+    """Ключ для склейки одинаковых запросов: схема https, хост в нижнем регистре, без трекинг-параметров и фрагмента."""
+    parts = urlsplit(url if "://" in url else "https://" + url)
+    query = [
+        (k, v)
+        for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in _TRACKING_PARAMS and not k.startswith("utm_")
+    ]
+    return urlunsplit(("https", parts.netloc.lower(), parts.path, urlencode(query), ""))
+
+
+def share_download(result: Tuple[str, str, str, int]) -> Tuple[str, str, str, int]:
+    """
+    Отдаёт второму запросу ту же скачанную ссылку в собственном tmpdir:
+    жёсткая ссылка на файл (без копирования данных), чтобы каждый удалял только своё.
+    """
+    filename, _, title, file_size = result
+    tmpdir = tempfile.mkdtemp(prefix="ytdlp-", dir=DOWNLOAD_DIR)
+    target = os.path.join(tmpdir, os.path.basename(filename))
     try:
-        loop = asyncio.get_running_loop()
+        try:
+            os.link(filename, target)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(filename, target)  # ФС без жёстких ссылок
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return target, tmpdir, title, file_size
+
+
+# Скачивания в процессе: одинаковые ссылки, присланные одновременно, качаются один раз
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+async def download_video(url: str) -> Tuple[Optional[Tuple[str, str, str, int]], Optional[str]]:
+    """Возвращает ((filename, tmpdir, title, file_size), None) или (None, текст ошибки). tmpdir удаляет вызывающий."""
+    key = normalize_url(url)
+    pending = _inflight.get(key)
+    if pending is not None:
+        try:
+            result, error_msg = await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+        else:
+            if result is None:
+                return None, error_msg
+            try:
+                return await asyncio.to_thread(share_download, result), None
+            except OSError as e:
+                # первый запрос уже отправил и удалил файл — качаем сами
+                logger.info(f"Cannot reuse in-flight download of {url}: {e}")
+        return await fetch_video(url)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        outcome = await fetch_video(url)
+        future.set_result(outcome)
+        return outcome
+    finally:
+        del _inflight[key]
+        if not future.done():
+            future.cancel()
+
+
+def run_download(
+    url: str, cookiefile: Optional[str], cookie_mtime: Optional[int], po_entry: Optional[str]
+) -> Tuple[str, str, str, int]:
+    """
+    Скачивает видео в собственный tmpdir в потоке (или процессе) пула;
+    возвращает (filename, tmpdir, title, file_size).
+    """
+    ydl = get_ydl(cookiefile, cookie_mtime, po_entry, YTDLP_UA)
+    logger.debug("Starting download for URL: %s", url)
+
+    # свой каталог на каждое скачивание — параллельные загрузки не затирают друг друга
+    tmpdir = tempfile.mkdtemp(prefix="ytdlp-", dir=DOWNLOAD_DIR)
+    ydl.params["paths"] = {"home": tmpdir}
+    try:
+        # один проход: слишком большие видео отсекает match_filter
+        info = ydl.extract_info(url, download=True)
+        logger.debug("Video info extracted: %s", info.get("title", "Unknown"))
+        # yt-dlp сам сообщает итоговый путь (после merge/remux) — угадывать расширение не нужно
+        requested = info.get("requested_downloads") or [{}]
+        filename = requested[0].get("filepath")
+        if not filename:
+            # max_filesize (размер известен из Content-Length) молча прерывает скачивание без файла
+            raise yt_dlp.utils.DownloadCancelled("file exceeds max size")
+
+        # стараемся иметь .mp4 (переименование внутри того же каталога)
+        if not filename.endswith(".mp4"):
+            new_filename = os.path.splitext(filename)[0] + ".mp4"
+            try:
+                os.replace(filename, new_filename)
+                filename = new_filename
+            except OSError:
+                pass
+
+        file_size = os.path.getsize(filename)
+        logger.debug("Downloaded file: %s, size: %s bytes", filename, file_size)
+        return filename, tmpdir, info.get("title", "video"), file_size
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+def run_download_in_process(
+    url: str, cookiefile: Optional[str], cookie_mtime: Optional[int], po_entry: Optional[str]
+) -> Tuple[str, str, str, int]:
+    """
+    run_download для ProcessPoolExecutor: ошибка возвращается в бота через pickle,
+    а ошибки yt-dlp хранят exc_info с traceback — такие заменяем на DownloadError с тем же текстом.
+    """
+    try:
+        return run_download(url, cookiefile, cookie_mtime, po_entry)
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            raise yt_dlp.utils.DownloadError(str(e)) from None
+        raise
+
+
+async def fetch_video(url: str) -> Tuple[Optional[Tuple[str, str, str, int]], Optional[str]]:
+    cookiefile, cookie_mtime = find_cookiefile()
+    download = run_download_in_process if YTDLP_PROCESS_POOL else run_download
 
-        def sync_download():
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                logger.debug(f"Starting download for URL: {url}")
-
-                # 1) Получим info без скачивания (оценка размера)
-                info = ydl.extract_info(url, download=False)
-                logger.debug(f"Video info extracted: {info.get('title', 'Unknown')}")
-
-                filesize = info.get("filesize") or info.get("filesize_approx")
-                if filesize and filesize > 50 * 1024 * 1024:
-                    raise Exception("Видео превышает максимальный размер (50 МБ)")
-
-                # 2) Скачиваем
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
-
-                # если название с другим расширением — попробуем угадать
-                if not os.path.exists(filename):
-                    base = os.path.splitext(filename)[0]
-                    for ext in [".mp4", ".webm", ".mkv", ".avi"]:
-                        test = base + ext
-                        if os.path.exists(test):
-                            filename = test
-                            break
-
-                # стараемся иметь .mp4 (без записи куда-либо кроме рабочей директории)
-                if not filename.endswith(".mp4") and os.path.exists(filename):
-                    base, _ = os.path.splitext(filename)
-                    new_filename = f"{base}.mp4"
-                    try:
-                        os.rename(filename, new_filename)
-                        filename = new_filename
-                    except Exception:
-                        pass
-
-                size_after = os.path.getsize(filename) if os.path.exists(filename) else 0
-                logger.debug(f"Downloaded file: {filename}, size: {size_after} bytes")
-                return filename, info.get("title", "video")
-
-        result = await loop.run_in_executor(None, sync_download)
+    try:
+        loop = asyncio.get_running_loop()
+        async with download_limiter.slot() as sample:
+            result = await loop.run_in_executor(
+                DOWNLOAD_EXECUTOR, download, url, cookiefile, cookie_mtime, PO_TOKEN_ENTRY
+            )
+            sample["size"] = result[3]
         return result, None
 
-    except yt_dlp.utils.MaxDownloadsReached:
+    # MaxDownloadsReached/RejectedVideoReached (match_filter) и обрыв из size_guard
+    except yt_dlp.utils.DownloadCancelled:
         logger.error("File exceeds max size")
         return None, "Видео превышает максимальный размер (50 МБ)."
     except yt_dlp.utils.UnsupportedError as e:
@@ -334,22 +1076,79 @@ async def download_video(url: str) -> Tuple[Optional[Tuple[str, str]], Optional[
 # =========================
 # TELEGRAM БОТ
 # =========================
-bot = Bot(token=get_telegram_token())
+def create_session() -> AiohttpSession:
+    if TELEGRAM_API_URL:
+        return AiohttpSession(
+            api=TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=True),
+            limit=TELEGRAM_POOL_LIMIT,
+        )
+    return AiohttpSession(limit=TELEGRAM_POOL_LIMIT)
+
+
+def create_bot() -> Bot:
+    # создаётся в main(): процессам пула скачиваний, импортирующим модуль, бот (и токен) не нужен
+    bot = Bot(token=get_telegram_token(), session=create_session())
+    bot.session.middleware(telegram_rate_limit)
+    return bot
+
+
 dp = Dispatcher()
 
 
+# Постоянные тексты и клавиатура собираются один раз, а не на каждое сообщение;
+# список платформ — в одном месте для приветствия и отказа
+STATS_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[[InlineKeyboardButton(text="📊 Моя статистика", callback_data="show_stats")]]
+)
+SUPPORTED_PLATFORMS_TEXT = "📱 Поддержка: YouTube, TikTok, Instagram, Twitter/X, Facebook."
+START_TEXT = (
+    "🎥 Привет! Я бот для скачивания видео.\n\n"
+    f"{SUPPORTED_PLATFORMS_TEXT}\n"
+    "⚠️ Лимит размера: 50 МБ.\n\n"
+    "Просто пришли ссылку."
+)
+UNSUPPORTED_PLATFORM_TEXT = f"🚫 Эта платформа не поддерживается.\n\n{SUPPORTED_PLATFORMS_TEXT}"
+INVALID_LINK_TEXT = (
+    "❌ Пришли корректную ссылку на видео.\n\n"
+    "Примеры:\n"
+    "• https://www.youtube.com/watch?v=...\n"
+    "• https://www.tiktok.com/@user/video/...\n"
+    "• https://www.instagram.com/p/...\n"
+    "• https://twitter.com/user/status/..."
+)
+RATE_LIMITED_TEXT = "⏱ Слишком часто. Подожди немного и пришли ссылку снова."
+NO_STATS_TEXT = "📊 У тебя пока нет статистики. Скачай первое видео!"
+
+
 @dp.message(CommandStart())
 async def start(message: types.Message):
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="📊 Моя статистика", callback_data="show_stats")]]
-    )
-    await message.reply(
-        "🎥 Привет! Я бот для скачивания видео.\n\n"
-        "📱 Поддержка: YouTube, TikTok, Instagram, Twitter/X, Facebook и др.\n"
-        "⚠️ Лимит размера: 50 МБ.\n\n"
-        "Просто пришли ссылку.",
-        reply_markup=keyboard,
-    )
+    await message.reply(START_TEXT, reply_markup=STATS_KEYBOARD)
+
+
+def render_user_stats(stats: dict) -> str:
+    """Текст экрана статистики; считается заново только после новых скачиваний."""
+    if stats["stats_text"] is not None:
+        return stats["stats_text"]
+
+    first_use = datetime.fromtimestamp(stats["first_use_ts"]).strftime("%d.%m.%Y")
+    last_activity = datetime.fromtimestamp(stats["last_activity_ts"]).strftime("%d.%m.%Y %H:%M")
+    favorite_platform = stats["favorite_platform"] or "Нет данных"
+    favorite_count = stats["favorite_count"]
+
+    lines = [
+        "📊 **Твоя статистика:**\n",
+        f"📥 Скачано видео: **{stats['downloads_count']}**",
+        f"💾 Общий размер: **{format_file_size(stats['total_size'])}**",
+        f"🏆 Любимая платформа: **{favorite_platform}** ({favorite_count} видео)",
+        f"📅 Первое использование: **{first_use}**",
+        f"🕐 Последняя активность: **{last_activity}**\n",
+        "🎯 **По платформам:**",
+    ]
+    # порядок как у любимой платформы: по убыванию числа видео, при равенстве по алфавиту
+    platforms = sorted(stats["platforms"].items(), key=lambda item: (-item[1], item[0]))
+    lines.extend(f"• {platform}: {count} видео" for platform, count in platforms)
+    stats["stats_text"] = "\n".join(lines) + "\n"
+    return stats["stats_text"]
 
 
 @dp.callback_query(F.data == "show_stats")
@@ -359,29 +1158,10 @@ async def show_stats_callback(callback: types.CallbackQuery):
     stats = get_user_stats(user_id)
 
     if not stats:
-        await callback.message.answer("📊 У тебя пока нет статистики. Скачай первое видео!")
+        await callback.message.answer(NO_STATS_TEXT)
         return
 
-    first_use = datetime.fromisoformat(stats["first_use"]).strftime("%d.%m.%Y")
-    last_activity = datetime.fromisoformat(stats["last_activity"]).strftime("%d.%m.%Y %H:%M")
-    favorite_platform = "Нет данных"
-    favorite_count = 0
-    if stats["platforms"]:
-        favorite_platform = max(stats["platforms"], key=stats["platforms"].get)
-        favorite_count = stats["platforms"][favorite_platform]
-
-    stats_text = (
-        f"📊 **Твоя статистика:**\n\n"
-        f"📥 Скачано видео: **{stats['downloads_count']}**\n"
-        f"💾 Общий размер: **{format_file_size(stats['total_size'])}**\n"
-        f"🏆 Любимая платформа: **{favorite_platform}** ({favorite_count} видео)\n"
-        f"📅 Первое использование: **{first_use}**\n"
-        f"🕐 Последняя активность: **{last_activity}**\n\n"
-        f"🎯 **По платформам:**\n"
-    )
-    for platform, count in stats["platforms"].items():
-        stats_text += f"• {platform}: {count} видео\n"
-
+    stats_text = render_user_stats(stats)
     try:
         await callback.message.edit_text(stats_text, parse_mode="Markdown")
     except Exception:
@@ -393,56 +1173,54 @@ async def handle_message(message: types.Message):
     user_id = message.from_user.id
     url = (message.text or "").strip()
 
-    if not is_valid_url(url):
-        await message.reply(
-            "❌ Пришли корректную ссылку на видео.\n\n"
-            "Примеры:\n"
-            "• https://www.youtube.com/watch?v=...\n"
-            "• https://www.tiktok.com/@user/video/...\n"
-            "• https://www.instagram.com/p/...\n"
-            "• https://twitter.com/user/status/..."
-        )
+    # ссылка разбирается один раз: и для проверки, и для статистики по платформе;
+    # только поддерживаемые платформы — остальное не стоит запуска yt-dlp
+    host = link_host(url)
+    platform = platform_for_host(host) if host else None
+    if platform is None:
+        if host is not None:
+            await message.reply(UNSUPPORTED_PLATFORM_TEXT)
+            return
+        await message.reply(INVALID_LINK_TEXT)
+        return
+
+    if not take_rate_token(user_id):
+        await message.reply(RATE_LIMITED_TEXT)
         return
 
     processing_msg = await message.reply("⏳ Скачиваю...")
 
-    result, error_msg = await download_video(url)
+    async with user_download_slot(user_id):
+        result, error_msg = await download_video(url)
     if result:
-        filename, title = result
+        filename, tmpdir, title, file_size = result
         try:
-            if not os.path.exists(filename):
-                await processing_msg.edit_text("❌ Ошибка: файл не найден после скачивания.")
-                return
-
-            file_size = os.path.getsize(filename)
-            if file_size > 50 * 1024 * 1024:
+            # размер уже ограничен при скачивании (max_filesize, size_guard); без прогресса от aria2c — проверяем здесь
+            if ARIA2C_ENABLED and file_size > MAX_FILE_SIZE:
                 await processing_msg.edit_text("❌ Видео слишком большое для Telegram (макс. 50 МБ).")
-                os.remove(filename)
                 return
 
-            await processing_msg.edit_text("📤 Отправляю видео...")
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[[InlineKeyboardButton(text="📊 Моя статистика", callback_data="show_stats")]]
-            )
-
+            if TELEGRAM_API_URL:
+                # локальный сервер сам читает файл с диска
+                video = f"file://{os.path.abspath(filename)}"
+            else:
+                video = types.FSInputFile(filename, chunk_size=UPLOAD_CHUNK_SIZE)
             await message.reply_video(
-                video=types.FSInputFile(filename),
+                video=video,
                 caption=f"✅ Скачано: {title}",
                 supports_streaming=True,
-                reply_markup=keyboard,
+                reply_markup=STATS_KEYBOARD,
             )
 
-            update_user_stats(user_id, detect_platform(url), file_size)
-            os.remove(filename)
-            await processing_msg.delete()
+            await asyncio.gather(
+                update_user_stats(user_id, platform, file_size),
+                processing_msg.delete(),
+            )
 
         except Exception as e:
             await processing_msg.edit_text(f"❌ Не удалось отправить видео: {str(e)}.")
-            if os.path.exists(filename):
-                try:
-                    os.remove(filename)
-                except Exception:
-                    pass
+        finally:
+            cleanup_queue.put_nowait(tmpdir)
     else:
         base = "❌ Не удалось скачать видео."
         hint = "\n\n💡 Проверь cookies.txt (Netscape) и poToken."
@@ -456,9 +1234,73 @@ async def handle_message(message: types.Message):
 # =========================
 # MAIN
 # =========================
+async def run_webhook(bot: Bot):
+    app = web.Application()
+    path = urlsplit(WEBHOOK_URL).path or "/"
+    secret = WEBHOOK_SECRET
+    if not secret:
+        # без секрета любой, кто знает адрес, может слать поддельные апдейты от чужого имени;
+        # вебхук регистрируем сами при каждом запуске, так что случайный токен ничего не ломает
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET is not set, using a random secret token for this run")
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(f"Webhook mode: listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{path}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+    finally:
+        await runner.cleanup()  # закрывает и сессию бота
+
+
 async def main():
+    # Блокирующие вызовы (БД, файлы, yt-dlp) уходят в пул — задаём его размер явно
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
+    )
+    bot = create_bot()
+    init_downloads()
+    # открытие БД, импорт user_stats.json и чтение всей таблицы — в потоке, не в event loop;
+    # обработчики ещё не запущены, поэтому user_stats пока никто не трогает
+    await asyncio.to_thread(init_stats_storage)
+    flusher = asyncio.create_task(stats_flusher())
+    sweeper = asyncio.create_task(rate_bucket_sweeper())
+    cleaner = asyncio.create_task(janitor())
     logger.info("Бот запущен")
-    await dp.start_polling(bot)
+    try:
+        if WEBHOOK_URL:
+            await run_webhook(bot)
+        else:
+            # вебхук от прошлого запуска в режиме WEBHOOK_URL блокирует getUpdates (409 Conflict)
+            await bot.delete_webhook()
+            # только нужные типы апдейтов; обработка идёт задачами, не задерживая следующий getUpdates
+            await dp.start_polling(
+                bot,
+                polling_timeout=POLLING_TIMEOUT,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+    finally:
+        flusher.cancel()
+        sweeper.cancel()
+        cleaner.cancel()
+        DOWNLOAD_EXECUTOR.shutdown(wait=True)
+        for tmpdir in drain_cleanup_queue():
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        # дописываем то, что не успел сбросить flusher
+        save_user_stats(drain_stats_queue())
 
 
 if __name__ == "__main__":